@@ -6,9 +6,77 @@ Reads Allure results and exposes metrics for Prometheus scraping
 
 import json
 import os
-import glob
-from http.server import HTTPServer, BaseHTTPRequestHandler
-from datetime import datetime
+import threading
+import time
+from collections import Counter, defaultdict
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+try:
+    # orjson is a much faster C parser; the exporter still runs on the
+    # standard library alone when it is not installed
+    from orjson import loads as json_loads
+except ImportError:
+    from json import loads as json_loads
+
+
+# Scalar metrics, filled from the parsed test statistics
+_TEMPLATE = """\
+# HELP test_total Total number of tests
+# TYPE test_total gauge
+test_total {total}
+# HELP test_passed_total Number of passed tests
+# TYPE test_passed_total gauge
+test_passed_total {passed}
+# HELP test_failed_total Number of failed tests
+# TYPE test_failed_total gauge
+test_failed_total {failed}
+# HELP test_skipped_total Number of skipped tests
+# TYPE test_skipped_total gauge
+test_skipped_total {skipped}
+# HELP test_broken_total Number of broken tests
+# TYPE test_broken_total gauge
+test_broken_total {broken}
+# HELP test_execution_duration_ms Total test execution duration in milliseconds
+# TYPE test_execution_duration_ms gauge
+test_execution_duration_ms {duration_ms}
+# HELP test_flaky_rate Percentage of flaky tests
+# TYPE test_flaky_rate gauge
+test_flaky_rate {flaky_rate}
+# HELP self_healing_attempt_count Number of self-healing attempts
+# TYPE self_healing_attempt_count counter
+self_healing_attempt_count {self_healing_attempts}
+# HELP self_healing_success_count Number of successful self-healing events
+# TYPE self_healing_success_count counter
+self_healing_success_count {self_healing_success}
+# HELP ai_data_generation_count Number of AI-generated test data items
+# TYPE ai_data_generation_count counter
+ai_data_generation_count {ai_data_count}
+"""
+
+# Headers for the labelled and per-scrape metric families
+_CATEGORY_HEADER = (
+    '# HELP test_count_by_category Test count by category\n'
+    '# TYPE test_count_by_category gauge\n'
+)
+_MODULE_HEADER = (
+    '# HELP test_pass_rate_by_module Pass rate by module\n'
+    '# TYPE test_pass_rate_by_module gauge\n'
+)
+_TIMESTAMP_HEADER = (
+    b'# HELP test_metrics_last_update_timestamp Last update timestamp\n'
+    b'# TYPE test_metrics_last_update_timestamp gauge\n'
+)
+
+# Result statuses counted individually; anything else only counts towards the total
+_STATUS_KEYS = frozenset({'passed', 'failed', 'skipped', 'broken'})
+
+# Allure label names reported as test categories, and all labels read
+_CATEGORY_LABELS = ('suite', 'feature', 'epic')
+_REPORTED_LABELS = frozenset(_CATEGORY_LABELS + ('package',))
+
+# Last rendered metrics body, keyed on the results directory fingerprint
+_CACHE = {"fp": None, "body": None}
+_CACHE_LOCK = threading.Lock()
 
 
 class MetricsHandler(BaseHTTPRequestHandler):
@@ -16,11 +84,12 @@ class MetricsHandler(BaseHTTPRequestHandler):
 
     def do_GET(self):
         if self.path == '/metrics':
-            metrics = generate_metrics()
+            # Served from the cache kept fresh by the background refresher
+            body = _CACHE["body"] or generate_metrics()
             self.send_response(200)
             self.send_header('Content-Type', 'text/plain; charset=utf-8')
             self.end_headers()
-            self.wfile.write(metrics.encode('utf-8'))
+            self.wfile.writelines((body, timestamp_metric()))
         elif self.path == '/health':
             self.send_response(200)
             self.send_header('Content-Type', 'application/json')
@@ -36,79 +105,80 @@ class MetricsHandler(BaseHTTPRequestHandler):
 
 
 def generate_metrics():
-    """Generate Prometheus metrics from test results"""
+    """Generate encoded Prometheus metrics from test results"""
     results_dir = os.environ.get('RESULTS_DIR', '/results')
-    metrics = []
-
-    # Test execution metrics
-    test_stats = parse_allure_results(results_dir)
 
-    # Basic test counts
-    metrics.append(f'# HELP test_total Total number of tests')
-    metrics.append(f'# TYPE test_total gauge')
-    metrics.append(f'test_total {test_stats["total"]}')
+    with _CACHE_LOCK:
+        # Reuse the last body while the results directory is unchanged
+        entries, fp = scan_result_files(results_dir)
+        if fp != _CACHE["fp"]:
+            test_stats = parse_allure_results(results_dir, entries)
+            _CACHE["body"] = render_metrics(test_stats).encode('utf-8')
+            _CACHE["fp"] = fp
 
-    metrics.append(f'# HELP test_passed_total Number of passed tests')
-    metrics.append(f'# TYPE test_passed_total gauge')
-    metrics.append(f'test_passed_total {test_stats["passed"]}')
+        return _CACHE["body"]
 
-    metrics.append(f'# HELP test_failed_total Number of failed tests')
-    metrics.append(f'# TYPE test_failed_total gauge')
-    metrics.append(f'test_failed_total {test_stats["failed"]}')
 
-    metrics.append(f'# HELP test_skipped_total Number of skipped tests')
-    metrics.append(f'# TYPE test_skipped_total gauge')
-    metrics.append(f'test_skipped_total {test_stats["skipped"]}')
-
-    metrics.append(f'# HELP test_broken_total Number of broken tests')
-    metrics.append(f'# TYPE test_broken_total gauge')
-    metrics.append(f'test_broken_total {test_stats["broken"]}')
-
-    # Execution duration
-    metrics.append(f'# HELP test_execution_duration_ms Total test execution duration in milliseconds')
-    metrics.append(f'# TYPE test_execution_duration_ms gauge')
-    metrics.append(f'test_execution_duration_ms {test_stats["duration_ms"]}')
-
-    # Flaky test rate
-    metrics.append(f'# HELP test_flaky_rate Percentage of flaky tests')
-    metrics.append(f'# TYPE test_flaky_rate gauge')
-    metrics.append(f'test_flaky_rate {test_stats["flaky_rate"]}')
-
-    # Tests by category
-    metrics.append(f'# HELP test_count_by_category Test count by category')
-    metrics.append(f'# TYPE test_count_by_category gauge')
-    for category, count in test_stats['by_category'].items():
-        metrics.append(f'test_count_by_category{{category="{category}"}} {count}')
+def _refresh_loop(interval):
+    """Keep the cached metrics body up to date so scrapes never parse results"""
+    while True:
+        try:
+            generate_metrics()
+        except Exception as e:
+            print(f"Error refreshing metrics: {e}")
+        time.sleep(interval)
 
-    # Tests by module
-    metrics.append(f'# HELP test_pass_rate_by_module Pass rate by module')
-    metrics.append(f'# TYPE test_pass_rate_by_module gauge')
-    for module, rate in test_stats['pass_rate_by_module'].items():
-        metrics.append(f'test_pass_rate_by_module{{module="{module}"}} {rate}')
 
-    # Self-healing metrics
-    metrics.append(f'# HELP self_healing_attempt_count Number of self-healing attempts')
-    metrics.append(f'# TYPE self_healing_attempt_count counter')
-    metrics.append(f'self_healing_attempt_count {test_stats.get("self_healing_attempts", 0)}')
+def timestamp_metric():
+    """Generate the encoded last-update timestamp metric"""
+    return _TIMESTAMP_HEADER + b'test_metrics_last_update_timestamp %d\n' % int(time.time())
 
-    metrics.append(f'# HELP self_healing_success_count Number of successful self-healing events')
-    metrics.append(f'# TYPE self_healing_success_count counter')
-    metrics.append(f'self_healing_success_count {test_stats.get("self_healing_success", 0)}')
 
-    # AI data generation count
-    metrics.append(f'# HELP ai_data_generation_count Number of AI-generated test data items')
-    metrics.append(f'# TYPE ai_data_generation_count counter')
-    metrics.append(f'ai_data_generation_count {test_stats.get("ai_data_count", 0)}')
+def render_metrics(test_stats):
+    """Render parsed test statistics in Prometheus text format"""
+    flaky_rate = _percent(test_stats['flaky_count'], test_stats['total'])
+    return _TEMPLATE.format_map({**test_stats, 'flaky_rate': flaky_rate}) + _render_labeled(test_stats)
 
-    # Timestamp
-    metrics.append(f'# HELP test_metrics_last_update_timestamp Last update timestamp')
-    metrics.append(f'# TYPE test_metrics_last_update_timestamp gauge')
-    metrics.append(f'test_metrics_last_update_timestamp {int(datetime.now().timestamp())}')
 
-    return '\n'.join(metrics) + '\n'
+def _render_labeled(test_stats):
+    """Render the per-category and per-module metric families"""
+    # Tests by category
+    by_category = ''.join(
+        f'test_count_by_category{{category="{category}"}} {count}\n'
+        for category, count in test_stats['by_category'].items()
+    )
+
+    # Pass rate by module
+    by_module = ''.join(
+        f'test_pass_rate_by_module{{module="{module}"}} {_percent(passed, total)}\n'
+        for module, (total, passed) in test_stats['module_counts'].items()
+    )
+
+    return _CATEGORY_HEADER + by_category + _MODULE_HEADER + by_module
+
+
+def _percent(part, total):
+    """Return part as a percentage of total, or 0 when total is 0"""
+    return (part / total) * 100 if total else 0
+
+
+def scan_result_files(results_dir):
+    """List result files and fingerprint the directory as (count, max mtime)"""
+    entries = []
+    max_mtime = 0
+    try:
+        with os.scandir(results_dir) as it:
+            for entry in it:
+                if entry.name.endswith('-result.json') and entry.is_file():
+                    entries.append(entry)
+                    max_mtime = max(max_mtime, entry.stat().st_mtime)
+    except OSError:
+        # Missing or unreadable results directory; report default metrics
+        pass
+    return entries, (len(entries), max_mtime)
 
 
-def parse_allure_results(results_dir):
+def parse_allure_results(results_dir, entries=None):
     """Parse Allure results directory and extract statistics"""
     stats = {
         'total': 0,
@@ -117,108 +187,130 @@ def parse_allure_results(results_dir):
         'skipped': 0,
         'broken': 0,
         'duration_ms': 0,
-        'flaky_rate': 0,
-        'by_category': {},
-        'pass_rate_by_module': {},
+        'flaky_count': 0,
+        'by_category': Counter(),
+        'module_counts': {},
         'self_healing_attempts': 0,
         'self_healing_success': 0,
         'ai_data_count': 0
     }
 
-    # Module stats tracking
-    module_stats = {}
+    # Module stats tracking as [total, passed]
+    module_stats = defaultdict(lambda: [0, 0])
+
+    # Per-result fields for the counting pass
+    statuses = []
+    durations = []
+    flaky = []
 
     # Parse result files
-    result_files = glob.glob(os.path.join(results_dir, '*-result.json'))
+    if entries is None:
+        entries, _ = scan_result_files(results_dir)
 
-    for file_path in result_files:
-        try:
-            with open(file_path, 'r') as f:
-                result = json.load(f)
-
-            stats['total'] += 1
-
-            # Status
-            status = result.get('status', 'unknown')
-            if status == 'passed':
-                stats['passed'] += 1
-            elif status == 'failed':
-                stats['failed'] += 1
-            elif status == 'skipped':
-                stats['skipped'] += 1
-            elif status == 'broken':
-                stats['broken'] += 1
-
-            # Duration
-            start = result.get('start', 0)
-            stop = result.get('stop', 0)
-            stats['duration_ms'] += (stop - start)
-
-            # Extract labels for categorization
-            labels = result.get('labels', [])
-            for label in labels:
-                name = label.get('name', '')
-                value = label.get('value', '')
-
-                # Category (suite, feature, story)
-                if name in ['suite', 'feature', 'epic']:
-                    if value not in stats['by_category']:
-                        stats['by_category'][value] = 0
-                    stats['by_category'][value] += 1
-
-                # Module tracking
-                if name == 'package':
-                    module = value.split('.')[-2] if '.' in value else value
-                    if module not in module_stats:
-                        module_stats[module] = {'total': 0, 'passed': 0}
-                    module_stats[module]['total'] += 1
-                    if status == 'passed':
-                        module_stats[module]['passed'] += 1
-
-            # Check for flaky marker
-            if result.get('flaky', False):
-                stats['flaky_rate'] += 1
-
-            # Check for self-healing in attachments/steps
-            steps = result.get('steps', [])
-            for step in steps:
-                step_name = step.get('name', '').lower()
-                if 'self-healing' in step_name or 'healed' in step_name:
-                    stats['self_healing_attempts'] += 1
-                    if step.get('status') == 'passed':
-                        stats['self_healing_success'] += 1
-                if 'ai-generated' in step_name or 'llm' in step_name:
-                    stats['ai_data_count'] += 1
-
-        except (json.JSONDecodeError, KeyError, IOError) as e:
-            print(f"Error parsing {file_path}: {e}")
+    for result in map(_load_result, entries):
+        if result is None:
             continue
 
-    # Calculate flaky rate percentage
-    if stats['total'] > 0:
-        stats['flaky_rate'] = (stats['flaky_rate'] / stats['total']) * 100
-
-    # Calculate pass rate by module
-    for module, data in module_stats.items():
-        if data['total'] > 0:
-            stats['pass_rate_by_module'][module] = (data['passed'] / data['total']) * 100
-        else:
-            stats['pass_rate_by_module'][module] = 0
+        # Status, duration and flaky marker are counted after the loop
+        status = result.get('status', 'unknown')
+        statuses.append(status)
+        durations.append(result.get('stop', 0) - result.get('start', 0))
+        flaky.append(bool(result.get('flaky', False)))
+
+        # Extract labels for categorization; names may repeat
+        for label in result.get('labels', []):
+            name = label.get('name')
+            if name not in _REPORTED_LABELS:
+                continue
+            value = label.get('value')
+            if not value:
+                continue
+
+            # Module tracking
+            if name == 'package':
+                counts = module_stats[_module_name(value)]
+                counts[0] += 1
+                if status == 'passed':
+                    counts[1] += 1
+
+            # Category (suite, feature, epic)
+            else:
+                stats['by_category'][value] += 1
+
+        # Check for self-healing in attachments/steps
+        steps = result.get('steps', [])
+        for step in steps:
+            step_name = (step.get('name') or '').lower()
+            if 'self-healing' in step_name or 'healed' in step_name:
+                stats['self_healing_attempts'] += 1
+                if step.get('status') == 'passed':
+                    stats['self_healing_success'] += 1
+            if 'ai-generated' in step_name or 'llm' in step_name:
+                stats['ai_data_count'] += 1
+
+    (stats['total'], stats['passed'], stats['failed'], stats['skipped'],
+     stats['broken'], stats['duration_ms'], stats['flaky_count']) = _reduce(statuses, durations, flaky)
+
+    # Rates are computed from these counts when rendering
+    stats['module_counts'] = {module: tuple(counts) for module, counts in module_stats.items()}
 
     # Default categories if none found
-    if not stats['by_category']:
+    if stats['by_category']:
+        stats['by_category'] = dict(stats['by_category'])
+    else:
         stats['by_category'] = {'smoke': 0, 'regression': 0, 'api': 0, 'ui': 0}
 
-    if not stats['pass_rate_by_module']:
-        stats['pass_rate_by_module'] = {'core': 0, 'ui': 0, 'api': 0}
+    if not stats['module_counts']:
+        stats['module_counts'] = {'core': (0, 0), 'ui': (0, 0), 'api': (0, 0)}
 
     return stats
 
 
+def _module_name(package):
+    """Return the second-to-last component of a dotted package name"""
+    end = package.rfind('.')
+    if end < 0:
+        return package
+    # rfind returns -1 when there is no earlier dot, so the slice starts at 0
+    return package[package.rfind('.', 0, end) + 1:end]
+
+
+def _load_result(entry):
+    """Read and decode one result file, or None if it cannot be parsed"""
+    try:
+        # Single unbuffered read sized from the stat cached by os.scandir
+        fd = os.open(entry.path, os.O_RDONLY)
+        try:
+            data = os.read(fd, entry.stat().st_size)
+        finally:
+            os.close(fd)
+        return json_loads(data)
+    except (json.JSONDecodeError, IOError) as e:
+        print(f"Error parsing {entry.path}: {e}")
+        return None
+
+
+def _reduce(statuses, durations, flaky):
+    """Count statuses, total duration and flaky results in a single pass"""
+    counts = dict.fromkeys(_STATUS_KEYS, 0)
+    total_duration = flaky_count = 0
+    for status, duration, is_flaky in zip(statuses, durations, flaky):
+        if status in _STATUS_KEYS:
+            counts[status] += 1
+        total_duration += duration
+        if is_flaky:
+            flaky_count += 1
+    return (len(statuses), counts['passed'], counts['failed'], counts['skipped'],
+            counts['broken'], total_duration, flaky_count)
+
+
 def main():
     """Start the metrics server"""
     port = int(os.environ.get('PORT', 8080))
-    server = HTTPServer(('0.0.0.0', port), MetricsHandler)
+    refresh_interval = int(os.environ.get('REFRESH_INTERVAL', 10))
+    threading.Thread(target=_refresh_loop, args=(refresh_interval,), daemon=True).start()
+
+    server = ThreadingHTTPServer(('0.0.0.0', port), MetricsHandler)
     print(f"Test Metrics Exporter running on port {port}")
     print(f"Metrics endpoint: http://localhost:{port}/metrics")
     print(f"Health endpoint: http://localhost:{port}/health")